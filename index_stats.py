@@ -0,0 +1,132 @@
+"""
+Index-time statistics for bounding retrieval scores.
+
+Computed when the index is built and stored next to the index, together with the identity of the index
+build they belong to:
+  - term_field_max: for each field and term, the maximum of n(t,d_f)/|d_f| over all documents
+  - doc_field_lengths: |d_f| of each document and field
+  - contained_fields: fields whose terms all occur in the contents field, i.e., for which
+    sum_f n(t,d_f) <= n(t,d_contents) holds in every document
+"""
+
+from __future__ import division
+import json
+import os
+
+INDEX_STATS_FILE = "index_stats.json"
+
+# Loaded statistics, by index directory
+loaded_stats = {}
+
+
+def latest_segments_file(index_dir):
+    """Returns the name of the latest segments_N file of a Lucene index, or None if there is no index."""
+    if index_dir is None or not os.path.isdir(index_dir):
+        return None
+    segments_files = [f for f in os.listdir(index_dir) if f.startswith("segments_")]
+    if not segments_files:
+        return None
+    return max(segments_files, key=lambda f: int(f[len("segments_"):], 36))
+
+
+def index_generation(index_dir):
+    """Returns the generation of a Lucene index, i.e., N of the latest segments_N file.
+
+    The generation is increased by Lucene on every commit; note that every new index starts at segments_1.
+
+    :param index_dir: Lucene index directory
+    :return: generation, or None if there is no index in the directory
+    """
+    segments_file = latest_segments_file(index_dir)
+    return int(segments_file[len("segments_"):], 36) if segments_file else None
+
+
+def index_id(index_dir):
+    """Returns the identity of a Lucene index build: its absolute path, generation, and the modification time
+    and size of its latest segments file.
+
+    The generation alone does not identify an index, since two indexes (or a deleted and rebuilt one) may
+    have the same generation.
+
+    :param index_dir: Lucene index directory
+    :return: list of the identity components, or None if there is no index in the directory
+    """
+    segments_file = latest_segments_file(index_dir)
+    if segments_file is None:
+        return None
+    path = os.path.join(index_dir, segments_file)
+    return [os.path.abspath(index_dir), int(segments_file[len("segments_"):], 36),
+            os.path.getmtime(path), os.path.getsize(path)]
+
+
+def compute_index_stats(lucene, doc_ids, fields, contents_field):
+    """Computes the statistics of the index.
+
+    :param lucene: Lucene object (with an open searcher)
+    :param doc_ids: IDs of all indexed documents
+    :param fields: field names
+    :param contents_field: name of the field holding the contents of all fields
+    :return: dictionary with term_field_max, doc_field_lengths and contained_fields
+    """
+    term_field_max = dict((f, {}) for f in fields)
+    doc_field_lengths = {}
+    contained = set(f for f in fields if f != contents_field)
+    for doc_id in doc_ids:
+        lucene_doc_id = lucene.get_lucene_document_id(doc_id)
+        if lucene_doc_id is None:
+            continue
+        doc_field_lengths[doc_id] = {}
+        doc_term_freqs = dict((f, lucene.get_doc_termfreqs(lucene_doc_id, f)) for f in fields)
+        for f in fields:
+            len_d_f = sum(doc_term_freqs[f].values())
+            doc_field_lengths[doc_id][f] = len_d_f
+            for t, doc_term_freq in doc_term_freqs[f].items():
+                p_t_d_f = doc_term_freq / len_d_f
+                if p_t_d_f > term_field_max[f].get(t, 0):
+                    term_field_max[f][t] = p_t_d_f
+        # keeps the fields that occur in the contents field (together)
+        if contents_field in doc_term_freqs:
+            for f in list(contained):
+                for t, doc_term_freq in doc_term_freqs[f].items():
+                    if doc_term_freq > doc_term_freqs[contents_field].get(t, 0):
+                        contained.discard(f)
+                        break
+            for t in doc_term_freqs[contents_field]:
+                if sum(doc_term_freqs[f].get(t, 0) for f in contained) > doc_term_freqs[contents_field][t]:
+                    contained = set()
+                    break
+        else:
+            contained = set()
+    return {'term_field_max': term_field_max,
+            'doc_field_lengths': doc_field_lengths,
+            'contained_fields': sorted(contained)}
+
+
+def save_index_stats(index_dir, stats):
+    """Stores the statistics in the index directory, for the current index build."""
+    stats = dict(stats, index_id=index_id(index_dir))
+    with open(os.path.join(index_dir, INDEX_STATS_FILE), "w") as f:
+        json.dump(stats, f)
+
+
+def load_index_stats(index_dir):
+    """Returns the statistics of the index.
+
+    :param index_dir: Lucene index directory
+    :return: dictionary with term_field_max, doc_field_lengths and contained_fields, or None if they are
+        missing or belong to another build of the index
+    """
+    current_id = index_id(index_dir)
+    if current_id is None:
+        return None
+    if index_dir in loaded_stats and loaded_stats[index_dir]['index_id'] == current_id:
+        return loaded_stats[index_dir]
+    path = os.path.join(index_dir, INDEX_STATS_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        stats = json.load(f)
+    if stats.get('index_id') != current_id:
+        return None
+    loaded_stats[index_dir] = stats
+    return stats
@@ -6,6 +6,7 @@ Toy indexer example.
 
 import sys
 from lucene_tools import Lucene
+import index_stats
 
 indexed_fields = ['product_name','title' ,'brand','short_description','description','characters','category','main_category','queries']
 def lucene_indexer(docs):
@@ -33,3 +34,11 @@ def lucene_indexer(docs):
 
     lucene.close_writer()
 
+    # statistics for bounding scores in top-k retrieval
+    print "Computing index statistics..."
+    lucene.open_searcher()
+    fields = set(f for doc in docs for f in doc if f != "docid")
+    stats = index_stats.compute_index_stats(lucene, [str(doc['docid']) for doc in docs], fields,
+                                            Lucene.FIELDNAME_CONTENTS)
+    index_stats.save_index_stats(index_dir, stats)
+
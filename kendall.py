@@ -38,27 +38,33 @@ def kendel_tau(listA,listB):
 	return numera/float(den) if den != 0 else 1
 		
 
-def main():
-	m1 = load_ranking("method1.txt")
-	m2 = load_ranking("method2.txt")
+"""
+:returns kendall tau of each query between two TREC run files
+"""
+def compare_runs(file1, file2):
+	m1 = load_ranking(file1)
+	m2 = load_ranking(file2)
 	print 'Loaded ranking ...'
 	listA = [] 
 	listB = []
-	accum_kend = []
+	taus = {}
 
 	for qid in m1:
 		for pair in m1[qid]:
 			pid = pair.keys()[0]
 			rank1 = pair.values()[0]
-			rank2 = next((r[pid] for r in m2[qid] if pid in r),0)
+			rank2 = next((r[pid] for r in m2.get(qid, []) if pid in r),0)
 			listA.append(int(rank1))
 			listB.append(int(rank2))
-		t = kendel_tau(listA,listB)
-		accum_kend.append(t)
+		taus[qid] = kendel_tau(listA,listB)
 		listA =[]
 		listB=[]
-	
-	print average(accum_kend)
+
+	return taus
+
+def main():
+	taus = compare_runs("method1.txt", "method2.txt")
+	print average(taus.values())
 	
 
 if __name__ == '__main__':
@@ -14,15 +14,16 @@
 #
 # You should have received a copy of the GNU Lesser General Public License
 # along with Living Labs Challenge. If not, see <http://www.gnu.org/licenses/>.
-import matplotlib.pyplot as plt
-import matplotlib.pylab as p
+
+# Heavy dependencies (requests, Lucene/JVM, matplotlib) are imported in the
+# methods that need them, so that e.g. a feedback poll starts quickly.
 import argparse
-import requests
 import json
 import time
 import random
 import os
-from nordlys.retrieval import indexer
+import sys
+from ranking_cache import RankingCache
 
 QUERYENDPOINT    = "participant/query"
 DOCENDPOINT      = "participant/doc"
@@ -34,138 +35,93 @@ OUTCOMEENDPOINT = "participant/outcome"
 
 HEADERS = {'content-type': 'application/json'}
 
-class Participant():
-	def __init__(self):
-		path = os.path.dirname(os.path.realpath(__file__))
-		description = "Living Labs Challenge's Participant Client"
-		parser = argparse.ArgumentParser(description=description)
-		parser.add_argument('--host', dest='host',
-							default='http://living-labs.net',
-							help='Host to listen on.')
-		parser.add_argument('--port', dest='port', default=5000, type=int,
-							help='Port to connect to.')
-		parser.add_argument('-k', '--key', type=str, required=True,
-							help='Provide a user key.')
-		parser.add_argument('-s', '--simulate_runs', action="store_true",
-							default=False,
-							help='Simulate runs.')
-		parser.add_argument('--store_run', action="store_true",
-							default=False,
-							help='Store TREC run (needs --run_file).')
-		parser.add_argument('--run_file',
-							default=os.path.normpath(os.path.join(path,
-													 "../../data/run.txt")),
-							help='Path to TREC style run file '
-							'(default: %(default)s).')
-		parser.add_argument('--get_feedback', action="store_true",
-							default=False,
-							help="Get feedback, if any")
-		parser.add_argument('--reset_feedback', action="store_true",
-							default=False,
-							help="Get feedback, if any")
-		parser.add_argument('--wait_min', type=int, default=1,
-							help='Minimum simulation waiting time in seconds.')
-		parser.add_argument('--wait_max', type=int, default=10,
-							help='Max simulation waiting time in seconds.')
-
-		args = parser.parse_args()
-		self.key = args.key
-		self.host = "%s:%s/api" % (args.host, args.port)
+PATH = os.path.dirname(os.path.realpath(__file__))
+DEFAULT_INDEX_DIR = "/livinglabs_index"
+DEFAULT_CACHE_DIR = os.path.normpath(os.path.join(PATH, "../../data/cache"))
+
+class Participant(object):
+	"""
+	:param key: user key
+	:param cache_dir: ranking and doclist cache directory (None disables the cache)
+	:param index_dir: Lucene index directory
+	"""
+	def __init__(self, key, host='http://living-labs.net', port=5000,
+				 cache_dir=DEFAULT_CACHE_DIR, index_dir=DEFAULT_INDEX_DIR):
+		self.key = key
+		self.host = "%s:%s/api" % (host, port)
 		if not self.host.startswith("http://"):
 			self.host = "http://" + self.host
+		self.index_dir = index_dir
 
 		self.runid = 0
-		
-		if args.store_run:
-			self.store_run(args.key, args.run_file)
-
-		if args.get_feedback:
-			self.get_feedbacks(args.key)
-
-		if args.reset_feedback:
-			self.reset_feedback(args.key)
-
-		if args.simulate_runs:
-			self.simulate_runs(args.key, args.wait_min, args.wait_max)
-
-	def get_queries(self):
-		url = "/".join([self.host, QUERYENDPOINT, self.key])
-		r = requests.get(url, headers=HEADERS)
+		self.cache_dir = cache_dir
+		self.ranking_cache = None
+
+	# the cache is created when first used (None if disabled or the directory is not writable)
+	@property
+	def cache(self):
+		if self.ranking_cache is None and self.cache_dir:
+			try:
+				self.ranking_cache = RankingCache(self.cache_dir, self.index_dir)
+			except OSError as e:
+				print "Ranking cache disabled: %s" % e
+				self.cache_dir = None
+		return self.ranking_cache
+
+	# sends a request to the API; url_parts follow the endpoint and the key
+	def request(self, method, endpoint, url_parts=[], data=None):
+		import requests
+		url = "/".join([self.host, endpoint, self.key] + url_parts)
+		r = requests.request(method, url, data=data, headers=HEADERS)
 		time.sleep(random.random())
 		if r.status_code != requests.codes.ok:
 			print r.text
 			r.raise_for_status()
-		
-		return r.json()
+		return r
+
+	def get_queries(self):
+		return self.request("GET", QUERYENDPOINT).json()
 		#return json.loads(r.text,encoding="utf-8")
 
-	def get_doclist(self,qid):
-		url = "/".join([self.host, DOCLISTENDPOINT, self.key, qid])
-		r = requests.get(url, headers=HEADERS)
-		time.sleep(random.random())
-		if r.status_code != requests.codes.ok:
-			print r.text
-			r.raise_for_status()
-		return r.json()
+	# doclists are served from the cache unless use_cache is False
+	def get_doclist(self,qid, use_cache=True):
+		if self.cache and use_cache:
+			doclist = self.cache.get_doclist(qid)
+			if doclist is not None:
+				return doclist
+		doclist = self.request("GET", DOCLISTENDPOINT, [qid]).json()
+		if self.cache:
+			self.cache.put_doclist(qid, doclist)
+		return doclist
 
 
 	def get_document(self,docid):
-		url = "/".join([self.host, DOCENDPOINT, self.key, docid])
-		r = requests.get(url, headers=HEADERS)
-		time.sleep(random.random())
-		if r.status_code != requests.codes.ok:
-			print r.text
-			r.raise_for_status()
-		return r.json()
+		return self.request("GET", DOCENDPOINT, [docid]).json()
 		
 		
 
 	# if qid == "all" returns feedback for all queries
 	def get_feedback(self, qid, runid=None):
-		urlList = [self.host, FEEDBACKENDPOINT, self.key, qid]
+		urlList = [qid]
 		if runid:
 			urlList.append(str(runid))
-		url = "/".join(urlList)
-		r = requests.get(url, headers=HEADERS)
-		time.sleep(random.random())
-		if r.status_code != requests.codes.ok:
-			print r.text
-			r.raise_for_status()
-		return r.json()
+		return self.request("GET", FEEDBACKENDPOINT, urlList).json()
 
 	def reset_feedback(self):
 		queries = self.get_queries()
 		for query in queries["queries"]:
-			qid = query["qid"]
-			url = "/".join([self.host, FEEDBACKENDPOINT, self.key, qid])
-			r = requests.delete(url, headers=HEADERS)
-			time.sleep(random.random())
-			if r.status_code != requests.codes.ok:
-				print r.text
-				r.raise_for_status()
+			self.request("DELETE", FEEDBACKENDPOINT, [query["qid"]])
 
 	def historical_feedback(self,qid):
-		urlList = [self.host, HISTORICALENDPOINT, self.key, qid]
-		url = "/".join(urlList)
-		r = requests.get(url, headers=HEADERS)
-		time.sleep(random.random())
-		if r.status_code != requests.codes.ok:
-			print r.text
-			r.raise_for_status()
-		return r.json()
+		return self.request("GET", HISTORICALENDPOINT, [qid]).json()
 
 
 	def store_runs(self, runs):
 		for qid in runs:
 			run = runs[qid]
 			run["runid"] = str(self.runid)
-			url = "/".join([self.host, RUNENDPOINT, self.key, qid])
 			print 'submitting ...%s'% qid 
-			r = requests.put(url, data=json.dumps(run), headers=HEADERS)
-			time.sleep(random.random())
-			if r.status_code != requests.codes.ok:
-				print r.text
-				r.raise_for_status()
+			self.request("PUT", RUNENDPOINT, [qid], data=json.dumps(run))
 
 		print "Your runs er submitted ...."
 
@@ -201,7 +157,7 @@ class Participant():
 			qid = query["qid"]
 			runs[qid] = self.get_doclist(qid)
 		feedbacks = {}
-		feedback_update = self.get_feedback(self.key, "all")
+		feedback_update = self.get_feedback("all")
 		for elem in feedback_update['feedback']:
 			self.update_runid(elem["runid"])
 		while True:
@@ -301,7 +257,7 @@ class Participant():
 				for doc in histo_feed['doclist']:
 					if doc['docid'] not in docids:
 						out.write(str(histo_feed['qid'] )+ " Q0 " + str(doc['docid']) + " " + str(float(doc['clicked']) * 1000)+ "\n")
-    					docids.append(doc['docid'])
+						docids.append(doc['docid'])
 
 
 	"""
@@ -347,27 +303,67 @@ class Participant():
 
 	"""
 	def index_products(self):
+		from nordlys.retrieval import indexer  # starts the JVM
+		doclists = {}
 		all_queries = self.get_queries()
 		for query in all_queries["queries"]:
 			qid = query["qid"]
 			print 'getting doclist for %s'%qid
-			doclists[qid] = self.get_doclist(qid)
+			doclists[qid] = self.get_doclist(qid, use_cache=False)
 	
 		unique_doc_ids = self.get_unique_documents(doclists)
 		alldox = self.prepare_dox(unique_doc_ids)	
 		print "Indexing documents..."
 		indexer.lucene_indexer(alldox)
 		print "Indexing finished successfully"
+		# the new index invalidates cached rankings; keeps the doclists it was built from
+		if self.cache:
+			self.cache.refresh_index()
+			for qid in doclists:
+				self.cache.put_doclist(qid, doclists[qid])
+
+	"""
+		: Gets the queries and (fresh) doclists, writes the queries for retrieval
+
+	"""
+	def harvest(self, jsonfile):
+		all_queries = self.get_queries()
+		self.prepare_json_queries(all_queries, jsonfile)
+		for query in all_queries["queries"]:
+			print 'getting doclist for %s'%query["qid"]
+			self.get_doclist(query["qid"], use_cache=False)
+
+	"""
+	:param config: retrieval config (see retrieval.json)
+	:param index_dir: Lucene index directory, overrides the one in the config
+	:ranks the doclist of each query and writes a TREC style run file
+	"""
+	def retrieve(self, config, index_dir=None):
+		from lucene_tools import Lucene  # starts the JVM
+		from scorer import Scorer
+		index_dir = index_dir or config.get('index_dir', self.index_dir)
+		lucene = Lucene(index_dir)
+		# rankings are keyed by the index they are computed on
+		if self.cache:
+			self.cache.set_index_dir(index_dir)
+		with open(config['query_file'], 'r') as f:
+			queries = json.load(f)
+		with open(config['output_file'], 'w') as out:
+			for query in queries:
+				qid = query['query_id']
+				print 'ranking %s' % qid
+				doc_ids = [doc['docid'] for doc in self.get_doclist(qid)['doclist']]
+				scorer = Scorer.get_scorer(config['model'], lucene, query['query'], dict(config, index_dir=index_dir))
+				if self.cache:
+					ranking = self.cache.rank(qid, scorer, doc_ids, config['num_docs'])
+				else:
+					ranking = scorer.score_docs_topk(doc_ids, config['num_docs'])
+				for rank, (docid, score) in enumerate(ranking, 1):
+					out.write(" ".join([qid, "Q0", docid, str(rank), str(score), config['run_id']]) + "\n")
+		print "Run written to %s" % config['output_file']
 
 	def outcome(self, qid):
-		url = "/".join([self.host, OUTCOMEENDPOINT, self.key, qid])
-		r = requests.get(url, headers=HEADERS)
-		time.sleep(random.random())
-		if r.status_code != requests.codes.ok:
-			print r.text
-			r.raise_for_status()
-		#print r.json()
-		return r.json()
+		return self.request("GET", OUTCOMEENDPOINT, [qid]).json()
 
 
 def proportionate_query(doc_queries):
@@ -379,12 +375,179 @@ def proportionate_query(doc_queries):
 
 	return repeated_terms
 
-def main():
-	
-	participant = Participant()
-	
-	
-if __name__ == '__main__':
-	main() 
+def harvest(participant, args):
+	participant.harvest(args.query_file)
 
-	
+def index(participant, args):
+	participant.index_products()
+
+def retrieve(participant, args):
+	with open(args.config, 'r') as f:
+		participant.retrieve(json.load(f), args.index_dir)
+
+def submit(participant, args):
+	participant.store_run(args.run_file)
+
+def feedback(participant, args):
+	if args.reset:
+		participant.reset_feedback()
+	else:
+		participant.get_feedbacks(args.qid)
+
+def simulate(participant, args):
+	participant.simulate_runs(args.wait_min, args.wait_max)
+
+def qrels(participant, args):
+	participant.prepare_qrels(args.qrels_file)
+
+def compare(args):
+	import kendall
+	taus = kendall.compare_runs(args.run_file1, args.run_file2)
+	for qid in sorted(taus):
+		print qid, taus[qid]
+	print "Average:", kendall.average(taus.values())
+	if args.plot:
+		import matplotlib.pyplot as plt
+		plt.hist(taus.values(), bins=20)
+		plt.xlabel("Kendall tau")
+		plt.ylabel("Queries")
+		plt.show()
+
+# flags of the old, single command client (deprecated)
+LEGACY_FLAGS = ['--store_run', '--retrieve', '--get_feedback', '--reset_feedback', '-s', '--simulate_runs']
+
+def parse_legacy_args(argv):
+	"""
+	:maps the flags of the old client onto subcommands, in the order the old client ran them
+	:returns list of args, one for each command
+	"""
+	print >> sys.stderr, ("Deprecated: use the subcommands instead "
+						  "(%s --help)" % os.path.basename(sys.argv[0]))
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--host', dest='host', default='http://living-labs.net')
+	parser.add_argument('--port', dest='port', default=5000, type=int)
+	parser.add_argument('-k', '--key', type=str, required=True)
+	parser.add_argument('-s', '--simulate_runs', action="store_true", default=False)
+	parser.add_argument('--store_run', action="store_true", default=False)
+	parser.add_argument('--run_file',
+						default=os.path.normpath(os.path.join(PATH, "../../data/run.txt")))
+	parser.add_argument('--retrieve', action="store_true", default=False)
+	parser.add_argument('--config', default=os.path.join(PATH, "retrieval.json"))
+	parser.add_argument('--get_feedback', action="store_true", default=False)
+	parser.add_argument('--reset_feedback', action="store_true", default=False)
+	parser.add_argument('--wait_min', type=int, default=1)
+	parser.add_argument('--wait_max', type=int, default=10)
+	parser.add_argument('--index_dir', default=None)
+	parser.add_argument('--cache_dir', default=DEFAULT_CACHE_DIR)
+	parser.add_argument('--no_cache', action="store_true", default=False)
+	args = vars(parser.parse_args(argv))
+
+	commands = []
+	if args['retrieve']:
+		commands.append(dict(args, command='retrieve', func=retrieve))
+	if args['store_run']:
+		commands.append(dict(args, command='submit', func=submit))
+	if args['get_feedback']:
+		commands.append(dict(args, command='feedback', func=feedback, qid="all", reset=False))
+	if args['reset_feedback']:
+		commands.append(dict(args, command='feedback', func=feedback, qid="all", reset=True))
+	if args['simulate_runs']:
+		commands.append(dict(args, command='simulate', func=simulate))
+	return [argparse.Namespace(**command) for command in commands]
+
+def main(argv=None):
+	description = "Living Labs Challenge's Participant Client"
+	parser = argparse.ArgumentParser(description=description)
+	subparsers = parser.add_subparsers(dest='command')
+
+	# options of the commands that talk to the API
+	api_parser = argparse.ArgumentParser(add_help=False)
+	api_parser.add_argument('--host', dest='host',
+							default='http://living-labs.net',
+							help='Host to listen on.')
+	api_parser.add_argument('--port', dest='port', default=5000, type=int,
+							help='Port to connect to.')
+	api_parser.add_argument('-k', '--key', type=str, required=True,
+							help='Provide a user key.')
+	api_parser.add_argument('--index_dir', default=None,
+							help='Path to the Lucene index (default: ' + DEFAULT_INDEX_DIR +
+							'; for retrieve, index_dir of the config).')
+	api_parser.add_argument('--cache_dir', default=DEFAULT_CACHE_DIR,
+							help='Path to the ranking and doclist cache '
+							'(default: %(default)s).')
+	api_parser.add_argument('--no_cache', action="store_true",
+							default=False,
+							help="Do not use the ranking and doclist cache.")
+
+	p = subparsers.add_parser('harvest', parents=[api_parser],
+							  help='Get queries and doclists.')
+	p.add_argument('--query_file', default="queries.json",
+				   help='Query file to write, in data/ (default: %(default)s).')
+	p.set_defaults(func=harvest)
+
+	p = subparsers.add_parser('index', parents=[api_parser],
+							  help='Get and index the documents of all doclists.')
+	p.set_defaults(func=index)
+
+	p = subparsers.add_parser('retrieve', parents=[api_parser],
+							  help='Rank the doclists and write a TREC run file.')
+	p.add_argument('--config', default=os.path.join(PATH, "retrieval.json"),
+				   help='Retrieval config (default: %(default)s).')
+	p.set_defaults(func=retrieve)
+
+	p = subparsers.add_parser('submit', parents=[api_parser],
+							  help='Store TREC run.')
+	p.add_argument('--run_file',
+				   default=os.path.normpath(os.path.join(PATH,
+											"../../data/run.txt")),
+				   help='Path to TREC style run file '
+				   '(default: %(default)s).')
+	p.set_defaults(func=submit)
+
+	p = subparsers.add_parser('feedback', parents=[api_parser],
+							  help='Get feedback, if any.')
+	p.add_argument('--qid', default="all",
+				   help='Query ID (default: %(default)s).')
+	p.add_argument('--reset', action="store_true", default=False,
+				   help='Reset feedback of all queries.')
+	p.set_defaults(func=feedback)
+
+	p = subparsers.add_parser('simulate', parents=[api_parser],
+							  help='Simulate runs.')
+	p.add_argument('--wait_min', type=int, default=1,
+				   help='Minimum simulation waiting time in seconds.')
+	p.add_argument('--wait_max', type=int, default=10,
+				   help='Max simulation waiting time in seconds.')
+	p.set_defaults(func=simulate)
+
+	p = subparsers.add_parser('qrels', parents=[api_parser],
+							  help='Create qrels from historical feedback.')
+	p.add_argument('--qrels_file', default="qrels.txt",
+				   help='Qrels file to write, in data/ (default: %(default)s).')
+	p.set_defaults(func=qrels)
+
+	p = subparsers.add_parser('compare',
+							  help="Kendall tau between two TREC run files.")
+	p.add_argument('run_file1')
+	p.add_argument('run_file2')
+	p.add_argument('--plot', action="store_true", default=False,
+				   help='Plot the distribution of Kendall tau.')
+	p.set_defaults(func=compare)
+
+	argv = sys.argv[1:] if argv is None else argv
+	if any(arg in LEGACY_FLAGS for arg in argv):
+		commands = parse_legacy_args(argv)
+	else:
+		commands = [parser.parse_args(argv)]
+	for args in commands:
+		if args.command == 'compare':
+			args.func(args)
+			continue
+		participant = Participant(args.key, args.host, args.port,
+								  None if args.no_cache else args.cache_dir,
+								  args.index_dir or DEFAULT_INDEX_DIR)
+		args.func(participant, args)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,187 @@
+"""
+Persistent cache for rankings and candidate doclists.
+
+Rankings are keyed by (qid, analyzed query, configuration hash, candidates hash, index identity) and
+doclists by (qid, index identity), so entries are invalidated automatically when the index is rebuilt or
+replaced, when the retrieval configuration changes or when the doclist of the query changes. Nothing is
+cached without an index. The cache is bounded by the total size of the entries in bytes; the least
+recently used entries are evicted first.
+"""
+
+import hashlib
+import json
+import os
+from index_stats import index_id
+
+# Configuration parameters that affect the ranking
+CONFIG_KEYS = ['model', 'method', 'field_weights', 'smoothing_param', 'smoothing_method', 'field',
+               'first_pass_num_docs', 'num_docs']
+
+
+def config_hash(params):
+    """Returns a hash of the ranking-related retrieval parameters.
+
+    :param params: retrieval parameters (e.g., the contents of retrieval.json)
+    :return: hex digest
+    """
+    config = dict((k, params[k]) for k in CONFIG_KEYS if k in params)
+    return hashlib.md5(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def candidates_hash(doc_ids, k):
+    """Returns a hash of the candidate documents and the number of documents to rank.
+
+    :param doc_ids: candidate document IDs
+    :param k: number of documents to return
+    :return: hex digest
+    """
+    return hashlib.md5(json.dumps([sorted(doc_ids), k]).encode('utf-8')).hexdigest()
+
+
+class RankingCache(object):
+    """File based ranking and doclist cache (one JSON file per entry)."""
+
+    def __init__(self, cache_dir, index_dir=None, max_size=100 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.index_dir = index_dir
+        self.max_size = max_size
+        self.index_id = index_id(index_dir)
+        self.size = None  # total size of the entries on disk in bytes, computed on the first put
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def refresh_index(self):
+        """Re-reads the index identity; to be called after the index has been (re)built."""
+        self.index_id = index_id(self.index_dir)
+
+    def set_index_dir(self, index_dir):
+        """Keys the entries by another index (the one the rankings are computed on)."""
+        self.index_dir = index_dir
+        self.refresh_index()
+
+    def get_path(self, key):
+        """Returns the path of the entry file for the key.
+
+        :param key: list of JSON serializable key components
+        """
+        key = json.dumps(key, sort_keys=True)
+        return os.path.join(self.cache_dir, hashlib.md5(key.encode('utf-8')).hexdigest() + ".json")
+
+    def get(self, key):
+        """Returns the cached value for the key, or None if it is not in the cache.
+
+        :param key: list of JSON serializable key components
+        """
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except ValueError:  # partially written or corrupt entry
+            return None
+        if entry['key'] != json.dumps(key, sort_keys=True):
+            return None
+        os.utime(path, None)  # marks the entry as recently used
+        return entry['value']
+
+    def put(self, key, value):
+        """Stores the value for the key and evicts the least recently used entries if the cache is full.
+
+        :param key: list of JSON serializable key components
+        :param value: JSON serializable value
+        """
+        path = self.get_path(key)
+        if self.size is None:
+            self.size = sum(os.path.getsize(entry) for entry in self.get_entries())
+        if os.path.exists(path):
+            self.size -= os.path.getsize(path)
+        with open(path + ".tmp", "w") as f:
+            json.dump({'key': json.dumps(key, sort_keys=True), 'value': value}, f)
+        os.rename(path + ".tmp", path)
+        self.size += os.path.getsize(path)
+        if self.size > self.max_size:
+            self.evict()
+
+    def get_entries(self):
+        return [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith(".json")]
+
+    def evict(self):
+        """Removes the least recently used entries, down to 90% of max_size so that evictions are rare."""
+        entries = self.get_entries()
+        entries.sort(key=os.path.getmtime)
+        self.size = sum(os.path.getsize(path) for path in entries)
+        for path in entries:
+            if self.size <= self.max_size * 0.9:
+                break
+            self.size -= os.path.getsize(path)
+            os.remove(path)
+
+    def ranking_key(self, qid, query_terms, params, doc_ids, k):
+        return ["ranking", qid, query_terms, config_hash(params), candidates_hash(doc_ids, k), self.index_id]
+
+    def doclist_key(self, qid):
+        return ["doclist", qid, self.index_id]
+
+    def get_ranking(self, qid, query_terms, params, doc_ids, k):
+        """Returns the cached ranking for the query, or None if the query is not cached for the current index.
+
+        :param qid: query ID
+        :param query_terms: analyzed query
+        :param params: retrieval parameters
+        :param doc_ids: candidate document IDs
+        :param k: number of documents to return
+        :return: list of (doc_id, score) tuples
+        """
+        if self.index_id is None:
+            return None
+        ranking = self.get(self.ranking_key(qid, query_terms, params, doc_ids, k))
+        return [tuple(r) for r in ranking] if ranking is not None else None
+
+    def put_ranking(self, qid, query_terms, params, doc_ids, k, ranking):
+        """Stores the ranking for the query; rankings are not cached if there is no index to key them with.
+
+        :param qid: query ID
+        :param query_terms: analyzed query
+        :param params: retrieval parameters
+        :param doc_ids: candidate document IDs
+        :param k: number of documents to return
+        :param ranking: list of (doc_id, score) tuples
+        """
+        if self.index_id is None:
+            return
+        self.put(self.ranking_key(qid, query_terms, params, doc_ids, k), ranking)
+
+    def rank(self, qid, scorer, doc_ids, k):
+        """Returns the top-k ranking of the candidate documents, from the cache if available.
+
+        :param qid: query ID
+        :param scorer: Scorer object for the query
+        :param doc_ids: candidate document IDs
+        :param k: number of documents to return
+        :return: list of (doc_id, score) tuples
+        """
+        ranking = self.get_ranking(qid, scorer.query_terms, scorer.params, doc_ids, k)
+        if ranking is None:
+            ranking = scorer.score_docs_topk(doc_ids, k)
+            self.put_ranking(qid, scorer.query_terms, scorer.params, doc_ids, k, ranking)
+        return ranking
+
+    def get_doclist(self, qid):
+        """Returns the cached candidate doclist of the query, or None if it is not cached for the current index.
+
+        :param qid: query ID
+        """
+        if self.index_id is None:
+            return None
+        return self.get(self.doclist_key(qid))
+
+    def put_doclist(self, qid, doclist):
+        """Stores the candidate doclist of the query; doclists are not cached if there is no index.
+
+        :param qid: query ID
+        :param doclist: doclist as returned by the API
+        """
+        if self.index_id is None:
+            return
+        self.put(self.doclist_key(qid), doclist)
@@ -5,7 +5,9 @@ Various retrieval models for scoring a individual document for a given query.
 """
 
 from __future__ import division
+import heapq
 import math
+import index_stats
 from lucene_tools import Lucene
 from org.apache.lucene.analysis.tokenattributes import CharTermAttribute
 from org.apache.lucene.search import CollectionStatistics
@@ -44,6 +46,15 @@ class Scorer(object):
         ts.close()
         return qterms
 
+    def score_docs_topk(self, doc_ids, k):
+        """Returns the k highest scoring documents.
+
+        :param doc_ids: candidate document IDs (ties are broken by this order)
+        :param k: number of documents to return
+        :return: list of (doc_id, score) tuples, sorted by score
+        """
+        return sorted([(doc_id, self.score_doc(doc_id)) for doc_id in doc_ids], key=lambda x: x[1], reverse=True)[:k]
+
     @staticmethod
     def get_scorer(model, lucene, query, params):
         """Returns Scorer object (Scorer factory).
@@ -68,22 +79,26 @@ class ScorerLM(Scorer):
         super(ScorerLM, self).__init__(lucene, query, params)
         self.smoothing_param = self.params.get('smoothing_param', 0.1)
 
-    def get_term_probs(self, lucene_doc_id, field):
+    def get_doc_termfreqs(self, lucene_doc_id, field):
+        """ Returns the term freqs for field of document; if the document is not in the index, all freqs are zero. """
+        if lucene_doc_id is None:
+            return {}
+        return self.lucene.get_doc_termfreqs(lucene_doc_id, field)
+
+    def get_term_probs(self, lucene_doc_id, field, doc_term_freqs=None):
         """ Returns probability of each term for the given field using JM smoothing
         i.e. for each term: p(t|theta_d_f) = [(1-lambda) n(t, d_f)/|d_f|] + [lambda n(t, C_f)/|C_f|]
 
         :param lucene_doc_id: internal Lucene document ID
         :param field: entity field name, e.g. <dbo:abstract>
+        :param doc_term_freqs: term freqs for field of document, if already read
         :return: dictionary of terms with their probabilities
         """
         if self.params.get('smoothing_method', "jm") != "jm":
             raise Exception("Err: Only JM smoothing is supported!")
 
-        # Gets term freqs for field of document
-        # If the document is not in the index, all freqs are zero
-        doc_term_freqs = {}
-        if lucene_doc_id is not None:
-            doc_term_freqs = self.lucene.get_doc_termfreqs(lucene_doc_id, field)
+        if doc_term_freqs is None:
+            doc_term_freqs = self.get_doc_termfreqs(lucene_doc_id, field)
 
         # Gets term probabilities
         len_d_f = sum(doc_term_freqs.values())
@@ -152,8 +167,14 @@ class ScorerLM(Scorer):
 class ScorerMLM(ScorerLM):
     """MLM scorer."""
 
+    # Slack for floating point rounding when comparing score upper bounds against the top-k threshold
+    TOPK_TOLERANCE = 1e-9
+
     def __init__(self, lucene, query, params):
         super(ScorerMLM, self).__init__(lucene, query, params)
+        self.mixture_weights = None
+        self.index_stats = None
+        self.topk_stats = {}
 
     # p(f|t) = p(t|C_f) * p(f)/ Sigma(p(t|C_f') * p(f'))
     """
@@ -176,7 +197,53 @@ class ScorerMLM(ScorerLM):
 
         p = float(term_coll_prob / sum_prob_t_C_f) if sum_prob_t_C_f != 0 else 0
         return p 
-        
+
+    def get_mixture_weights(self):
+        """Returns the field weight mu_f of each query term.
+
+        The weights only depend on the term and the collection statistics (not on the document),
+        so they are computed once per query and reused for all documents.
+
+        :return: dictionary {term: {field: mu_f}}
+        """
+        if self.mixture_weights is None:
+            weights = self.params['field_weights']
+            method = self.params['method']
+            self.mixture_weights = {}
+            for t in set(self.query_terms):
+                self.mixture_weights[t] = {}
+                for f in weights:
+                    if method == 'method1':
+                        self.mixture_weights[t][f] = weights[f]  ## METHOD 1
+                    else:
+                        self.mixture_weights[t][f] = self.mapping_f_t(t, f)  ## METHODS 2,3
+        return self.mixture_weights
+
+    def score_field_term_probs(self, field_term_probs):
+        """ Combines the field term probabilities of a document into its MLM score.
+
+        :param field_term_probs: dictionary {field: {term: p(t|theta_d_f)}}
+        :return: log(p(q|theta_d))
+        """
+        mu = self.get_mixture_weights()
+        # p(q|theta_d) = prod(p(t|theta_d)) ; we return log(p(q|theta_d))
+        p_q_theta_d = 0
+        for t in self.query_terms:
+            if self.SCORER_DEBUG:
+                print "\tt=" + t
+            # p(t|theta_d) = sum(mu_f * p(t|theta_d_f))
+            p_t_theta_d = 0
+            for f in self.params['field_weights']:
+                p_t_theta_d += mu[t][f] * field_term_probs[f][t]
+                if self.SCORER_DEBUG:
+                    print "\t\t\tf=" + f + ", mu_f=" + str(mu[t][f]) + "  P(t|theta_d,f)=" + str(field_term_probs[f][t])
+            # Skips the term if it is not in the field collection
+            if p_t_theta_d == 0:
+                continue
+            p_q_theta_d += math.log(p_t_theta_d)
+            if self.SCORER_DEBUG:
+                print "\t\tP(t|theta_d)=" + str(p_t_theta_d)
+        return p_q_theta_d
 
     def score_doc(self, doc_id, lucene_doc_id=None):
         """ Scores a given entity using the Mixture of Language Models (using JM smoothing)"""
@@ -184,7 +251,6 @@ class ScorerMLM(ScorerLM):
             lucene_doc_id = self.lucene.get_lucene_document_id(doc_id)
 
         weights = self.params['field_weights']
-        method = self.params['method']
         # gets term prob for each field
         field_term_probs = {}
         for field in weights.keys():
@@ -193,28 +259,185 @@ class ScorerMLM(ScorerLM):
         if self.SCORER_DEBUG:
             print "Scoring doc ID=" + doc_id
 
-        # p(q|theta_d) = prod(p(t|theta_d)) ; we return log(p(q|theta_d))
+        return self.score_field_term_probs(field_term_probs)
+
+    def get_term_field_bounds(self):
+        """ Returns what mu_f * p(t|theta_d_f) consists of, for bounding it over all documents.
+
+        With JM smoothing mu_f * p(t|theta_d_f) = [mu_f (1-lambda) n(t,d_f)/|d_f|] + [mu_f lambda p(t|C_f)], i.e., a
+        constant plus a document dependent part. The maximum of n(t,d_f)/|d_f| is taken from the statistics
+        computed at index time (see index_stats); if they are not available for the index, it is bounded by 1
+        (or 0 if t does not occur in the field collection).
+
+        :return: tuple of dictionaries {term: {field: value}} with mu_f lambda p(t|C_f) (the lower bound), with
+            mu_f (1-lambda) and with the maximum of n(t,d_f)/|d_f|
+        """
+        mu = self.get_mixture_weights()
+        term_field_max = self.get_index_stats().get('term_field_max', {})
+        lower, doc_weight, p_t_d_f_max = {}, {}, {}
+        for t in set(self.query_terms):
+            lower[t], doc_weight[t], p_t_d_f_max[t] = {}, {}, {}
+            for f in self.params['field_weights']:
+                len_C_f = self.lucene.get_coll_length(f)
+                coll_term_freq = self.lucene.get_coll_termfreq(t, f)
+                p_t_C_f = coll_term_freq / len_C_f if len_C_f > 0 else 0
+                lower[t][f] = mu[t][f] * self.smoothing_param * p_t_C_f
+                doc_weight[t][f] = mu[t][f] * (1 - self.smoothing_param)
+                if coll_term_freq == 0:
+                    p_t_d_f_max[t][f] = 0
+                elif f in term_field_max:
+                    p_t_d_f_max[t][f] = term_field_max[f].get(t, 1)
+                else:
+                    p_t_d_f_max[t][f] = 1
+        return lower, doc_weight, p_t_d_f_max
+
+    def get_index_stats(self):
+        """Returns the index statistics (see index_stats), or an empty dictionary if they are not available."""
+        if self.index_stats is None:
+            self.index_stats = index_stats.load_index_stats(self.params.get('index_dir')) or {}
+        return self.index_stats
+
+    def score_upper_bound(self, field_term_freqs, field_term_probs, doc_field_lengths, bounds):
+        """ Upper bound of the MLM score of a document of which only some of the fields have been read.
+
+        The unread fields are assumed to have the maximum n(t,d_f)/|d_f| of the collection. Once the contents
+        field is read and the field lengths of the document are known, the occurrences of t in the contents
+        field that are not in the read fields are distributed over the unread fields that occur in the contents
+        field, most valuable (mu_f (1-lambda) / |d_f|) first.
+
+        Terms with p(t|theta_d) = 0 are skipped by score_field_term_probs(), i.e., they add log(1) = 0 to the
+        score. Terms that may still turn out to have zero probability are therefore bounded by max(log(p), 0).
+
+        :param field_term_freqs: dictionary {field: {term: n(t,d_f)}} for the fields read so far
+        :param field_term_probs: dictionary {field: {term: p(t|theta_d_f)}} for the fields read so far
+        :param doc_field_lengths: dictionary {field: |d_f|} of the document, or None if not known
+        :param bounds: see get_term_field_bounds()
+        :return: upper bound of log(p(q|theta_d))
+        """
+        lower, doc_weight, p_t_d_f_max = bounds
+        mu = self.get_mixture_weights()
+        unread = [f for f in self.params['field_weights'] if f not in field_term_probs]
+        contained = []
+        if Lucene.FIELDNAME_CONTENTS in field_term_freqs and doc_field_lengths is not None:
+            contained = [f for f in self.get_index_stats().get('contained_fields', []) if f in doc_field_lengths]
+
         p_q_theta_d = 0
         for t in self.query_terms:
-            if self.SCORER_DEBUG:
-                print "\tt=" + t
-            # p(t|theta_d) = sum(mu_f * p(t|theta_d_f))
-            p_t_theta_d = 0
-            for f in weights:
-                if method == 'method1':    
-                    p_t_theta_d += weights[f] * field_term_probs[f][t] ## METHOD 1
-                else :
-                    p_t_theta_d += self.mapping_f_t(t,f) * field_term_probs[f][t]  ## METHODS 2,3
-                if self.SCORER_DEBUG:
-                    print "\t\t\tf=" + f + ", mu_f=" + str(self.mapping_f_t(t,f)) + "  P(t|theta_d,f)=" + str(field_term_probs[f][t])
-            # Skips the term if it is not in the field collection
-            if p_t_theta_d == 0:
+            p_t_theta_d_min = 0
+            for f in self.params['field_weights']:
+                if f in field_term_probs:
+                    p_t_theta_d_min += mu[t][f] * field_term_probs[f][t]
+                else:
+                    p_t_theta_d_min += lower[t][f]
+            p_t_theta_d_max = p_t_theta_d_min
+            for f in unread:
+                if f not in contained:
+                    p_t_theta_d_max += doc_weight[t][f] * p_t_d_f_max[t][f]
+            if contained:
+                # fractional knapsack of the remaining occurrences
+                remaining = field_term_freqs[Lucene.FIELDNAME_CONTENTS].get(t, 0)
+                remaining -= sum(field_term_freqs[f].get(t, 0) for f in contained if f in field_term_freqs)
+                knapsack = [f for f in unread if f in contained and doc_field_lengths[f] > 0]
+                for f in sorted(knapsack, key=lambda f: doc_weight[t][f] / doc_field_lengths[f], reverse=True):
+                    if remaining <= 0:
+                        break
+                    n = min(remaining, p_t_d_f_max[t][f] * doc_field_lengths[f])
+                    p_t_theta_d_max += doc_weight[t][f] * n / doc_field_lengths[f]
+                    remaining -= n
+            if p_t_theta_d_max == 0:
                 continue
-            p_q_theta_d += math.log(p_t_theta_d)
-            if self.SCORER_DEBUG:
-                print "\t\tP(t|theta_d)=" + str(p_t_theta_d)
+            if p_t_theta_d_min == 0:
+                p_q_theta_d += max(math.log(p_t_theta_d_max), 0)
+            else:
+                p_q_theta_d += math.log(p_t_theta_d_max)
         return p_q_theta_d
 
+    def score_docs_topk(self, doc_ids, k):
+        """ Returns the k highest scoring documents, without reading all fields of documents that cannot make it
+        into the top-k.
+
+        The contents field (or else the field with the largest possible contribution) is read for all documents
+        first, which gives an upper bound on each score (see score_upper_bound()). Documents are then scored one
+        at a time in decreasing order of their bounds, keeping the current top-k in a min-heap: a document is
+        dropped as soon as its bound falls below the lowest score in the heap, and once the bound of the next
+        document is below it, so are those of all remaining documents (MaxScore-style pruning).
+        The result is the same as the top-k of scoring all documents with score_doc().
+
+        :param doc_ids: candidate document IDs (ties are broken by this order)
+        :param k: number of documents to return
+        :return: list of (doc_id, score) tuples, sorted by score
+        """
+        bounds = self.get_term_field_bounds()
+        lower, doc_weight, p_t_d_f_max = bounds
+        terms = set(self.query_terms)
+        fields = sorted(self.params['field_weights'], key=lambda f: sum(doc_weight[t][f] * p_t_d_f_max[t][f]
+                                                                        for t in terms), reverse=True)
+        if Lucene.FIELDNAME_CONTENTS in fields and self.get_index_stats().get('contained_fields'):
+            fields.remove(Lucene.FIELDNAME_CONTENTS)
+            fields.insert(0, Lucene.FIELDNAME_CONTENTS)
+        doc_field_lengths = self.get_index_stats().get('doc_field_lengths', {})
+        self.topk_stats = {'candidates': len(doc_ids), 'scored': 0, 'pruned': 0, 'field_reads': 0,
+                           'exhaustive_field_reads': len(doc_ids) * len(fields)}
+        if k <= 0:
+            return []
+
+        # (upper bound, -position, doc_id, lucene_doc_id, field_term_freqs, field_term_probs), first field read
+        candidates = []
+        for pos, doc_id in enumerate(doc_ids):
+            lucene_doc_id = self.lucene.get_lucene_document_id(doc_id)
+            field_term_freqs = {fields[0]: self.get_doc_termfreqs(lucene_doc_id, fields[0])}
+            field_term_probs = {fields[0]: self.get_term_probs(lucene_doc_id, fields[0], field_term_freqs[fields[0]])}
+            upper_bound = self.score_upper_bound(field_term_freqs, field_term_probs, doc_field_lengths.get(doc_id),
+                                                 bounds)
+            candidates.append((upper_bound, -pos, doc_id, lucene_doc_id, field_term_freqs, field_term_probs))
+        self.topk_stats['field_reads'] += len(candidates)
+        candidates.sort(key=lambda c: c[:2], reverse=True)
+
+        heap = []  # min-heap of (score, -position, doc_id); the root is the current k-th document
+        for i, (upper_bound, neg_pos, doc_id, lucene_doc_id, field_term_freqs, field_term_probs) in enumerate(candidates):
+            if len(heap) == k and self.below_threshold(upper_bound, heap[0][0]):
+                self.topk_stats['pruned'] += len(candidates) - i
+                break
+            for f in self.get_field_order(fields, doc_field_lengths.get(doc_id), doc_weight):
+                if len(heap) == k and self.below_threshold(
+                        self.score_upper_bound(field_term_freqs, field_term_probs, doc_field_lengths.get(doc_id),
+                                               bounds), heap[0][0]):
+                    break
+                field_term_freqs[f] = self.get_doc_termfreqs(lucene_doc_id, f)
+                field_term_probs[f] = self.get_term_probs(lucene_doc_id, f, field_term_freqs[f])
+                self.topk_stats['field_reads'] += 1
+            if len(field_term_probs) < len(fields):
+                self.topk_stats['pruned'] += 1
+                continue
+
+            self.topk_stats['scored'] += 1
+            entry = (self.score_field_term_probs(field_term_probs), neg_pos, doc_id)
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+
+        if self.SCORER_DEBUG:
+            print "Top-k stats: " + str(self.topk_stats)
+        return [(doc_id, score) for score, _, doc_id in sorted(heap, reverse=True)]
+
+    def get_field_order(self, fields, doc_field_lengths, doc_weight):
+        """ Returns the order of reading the fields of a document after the first one.
+
+        If the field lengths of the document are known, the fields are read in the order the occurrences are
+        distributed over them by score_upper_bound(), i.e., by the largest mu_f (1-lambda) / |d_f| of the query
+        terms; empty fields last.
+        """
+        if doc_field_lengths is None or not all(f in doc_field_lengths for f in fields[1:]):
+            return fields[1:]
+        terms = set(self.query_terms)
+        return sorted(fields[1:], key=lambda f: max(doc_weight[t][f] for t in terms) / doc_field_lengths[f]
+                      if doc_field_lengths[f] > 0 else 0, reverse=True)
+
+    def below_threshold(self, upper_bound, threshold):
+        """Checks if a score upper bound is below the top-k threshold, with a margin for rounding errors."""
+        return upper_bound + self.TOPK_TOLERANCE * (1 + abs(upper_bound)) < threshold
+
       
 
 if __name__ == '__main__':
@@ -0,0 +1,85 @@
+"""
+Tests for the ranking and doclist cache.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ranking_cache import RankingCache
+
+PARAMS = {'model': 'mlm', 'method': 'method3', 'field_weights': {'brand': 0.2, 'contents': 0.8},
+          'smoothing_param': 0.1}
+
+
+class RankingCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.index_dir = os.path.join(self.dir, "index")
+        os.makedirs(self.index_dir)
+        open(os.path.join(self.index_dir, "segments_a"), "w").close()
+        self.cache = RankingCache(os.path.join(self.dir, "cache"), self.index_dir, max_size=1000)
+
+    def make_index(self, name, segments_file="segments_1", mtime=1000):
+        index_dir = os.path.join(self.dir, name)
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        open(os.path.join(index_dir, segments_file), "w").close()
+        os.utime(os.path.join(index_dir, segments_file), (mtime, mtime))
+        return index_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_ranking_key(self):
+        self.assertEqual(self.cache.index_id[:2], [os.path.abspath(self.index_dir), 10])
+        self.cache.put_ranking("q1", ["lego"], PARAMS, ["d1", "d2"], 1, [("d1", -1.5)])
+        self.assertEqual(self.cache.get_ranking("q1", ["lego"], PARAMS, ["d2", "d1"], 1), [("d1", -1.5)])
+        self.assertIsNone(self.cache.get_ranking("q1", ["lego"], dict(PARAMS, smoothing_param=0.2), ["d1", "d2"], 1))
+        self.assertIsNone(self.cache.get_ranking("q1", ["lego"], PARAMS, ["d1", "d2", "d3"], 1))
+        self.assertIsNone(self.cache.get_ranking("q1", ["lego"], PARAMS, ["d1", "d2"], 2))
+
+    def test_index_generation(self):
+        self.cache.put_ranking("q1", ["lego"], PARAMS, ["d1"], 1, [("d1", -1.5)])
+        self.cache.put_doclist("q1", {'doclist': [{'docid': "d1"}]})
+        os.rename(os.path.join(self.index_dir, "segments_a"), os.path.join(self.index_dir, "segments_b"))
+        self.cache.refresh_index()
+        self.assertIsNone(self.cache.get_ranking("q1", ["lego"], PARAMS, ["d1"], 1))
+        self.assertIsNone(self.cache.get_doclist("q1"))
+
+    def test_same_generation_different_index(self):
+        index_a, index_b = self.make_index("index_a"), self.make_index("index_b")
+        self.cache.set_index_dir(index_a)
+        self.cache.put_ranking("q1", ["lego"], PARAMS, ["d1"], 1, [("d1", -1.5)])
+        self.cache.set_index_dir(index_b)
+        self.assertIsNone(self.cache.get_ranking("q1", ["lego"], PARAMS, ["d1"], 1))
+        # index A deleted and rebuilt
+        shutil.rmtree(index_a)
+        self.make_index("index_a", mtime=2000)
+        self.cache.set_index_dir(index_a)
+        self.assertIsNone(self.cache.get_ranking("q1", ["lego"], PARAMS, ["d1"], 1))
+
+    def test_no_index(self):
+        self.cache.set_index_dir(os.path.join(self.dir, "missing"))
+        self.cache.put_doclist("q1", {'doclist': [{'docid': "d1"}]})
+        self.cache.put_ranking("q1", ["lego"], PARAMS, ["d1"], 1, [("d1", -1.5)])
+        self.assertEqual(self.cache.get_entries(), [])
+        self.cache.set_index_dir(self.index_dir)
+        self.cache.put_doclist("q1", {'doclist': [{'docid': "d1"}]})
+        cache = RankingCache(self.cache.cache_dir, os.path.join(self.dir, "missing"))
+        self.assertIsNone(cache.get_doclist("q1"))
+
+    def test_eviction(self):
+        for i in range(25):
+            self.cache.put_doclist("q%d" % i, {'doclist': []})
+            os.utime(self.cache.get_path(self.cache.doclist_key("q%d" % i)), (i, i))
+        self.assertLessEqual(sum(os.path.getsize(path) for path in self.cache.get_entries()), 1000)
+        self.assertEqual(self.cache.size, sum(os.path.getsize(path) for path in self.cache.get_entries()))
+        self.assertEqual(self.cache.get_doclist("q24"), {'doclist': []})
+        self.assertIsNone(self.cache.get_doclist("q0"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+"""
+Tests for top-k retrieval with the MLM scorer, against an in-memory stand-in for Lucene.
+"""
+
+from __future__ import division
+import random
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+# scorer.py imports Lucene and the JVM classes at module load; the in-memory index below replaces them
+for name in ["lucene_tools", "org", "org.apache", "org.apache.lucene", "org.apache.lucene.analysis",
+             "org.apache.lucene.analysis.tokenattributes", "org.apache.lucene.search"]:
+    sys.modules.setdefault(name, types.ModuleType(name))
+sys.modules["org.apache.lucene.analysis.tokenattributes"].CharTermAttribute = None
+sys.modules["org.apache.lucene.search"].CollectionStatistics = None
+
+
+class FakeLucene(object):
+    """In-memory index with the part of the Lucene API used by the scorer: {doc_id: {field: {term: freq}}}."""
+
+    FIELDNAME_CONTENTS = "contents"
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.coll_termfreqs = {}
+        self.coll_lengths = {}
+        for doc in docs.values():
+            for f, term_freqs in doc.items():
+                for t, n in term_freqs.items():
+                    self.coll_termfreqs[(t, f)] = self.coll_termfreqs.get((t, f), 0) + n
+                    self.coll_lengths[f] = self.coll_lengths.get(f, 0) + n
+
+    def open_searcher(self):
+        pass
+
+    def get_lucene_document_id(self, doc_id):
+        return doc_id if doc_id in self.docs else None
+
+    def get_doc_termfreqs(self, lucene_doc_id, field):
+        return dict(self.docs[lucene_doc_id].get(field, {}))
+
+    def get_coll_length(self, field):
+        return self.coll_lengths.get(field, 0)
+
+    def get_coll_termfreq(self, term, field):
+        return self.coll_termfreqs.get((term, field), 0)
+
+sys.modules["lucene_tools"].Lucene = FakeLucene
+
+import index_stats
+from scorer import ScorerMLM
+
+FIELD_WEIGHTS = {"brand": 0.024, "product_name": 0.2, "contents": 0.25, "description": 0.14,
+                 "characters": 0.13, "category": 0.15, "short_description": 0.1}
+
+
+class TestScorer(ScorerMLM):
+    """MLM scorer taking the analyzed query from the params."""
+
+    def analyze_query(self):
+        return self.params['query_terms']
+
+
+def zipf(items):
+    """Draws an item with a skewed (roughly Zipfian) distribution."""
+    return items[min(int(len(items) ** random.random()) - 1, len(items) - 1)]
+
+
+def bag(terms):
+    term_freqs = {}
+    for t in terms:
+        term_freqs[t] = term_freqs.get(t, 0) + 1
+    return term_freqs
+
+
+def product_docs(num_docs):
+    """Generates product-like documents: short brand/category/name fields and longer descriptions."""
+    brands = ["b%d" % i for i in range(100)]
+    cats = ["c%d" % i for i in range(50)]
+    words = ["w%d" % i for i in range(2000)]
+    docs = {}
+    for i in range(num_docs):
+        brand, cat = zipf(brands), zipf(cats)
+        doc = {
+            'brand': bag([brand]),
+            'category': bag([cat, zipf(words)]),
+            'product_name': bag([brand, cat] + [zipf(words) for _ in range(random.randint(1, 4))]),
+            'short_description': bag([zipf(words + cats + brands) for _ in range(random.randint(3, 15))]),
+            'description': bag([zipf(words + cats + brands) for _ in range(random.randint(10, 60))]),
+            'characters': bag([zipf(words) for _ in range(random.randint(2, 10))]),
+        }
+        contents = {}
+        for term_freqs in doc.values():
+            for t, n in term_freqs.items():
+                contents[t] = contents.get(t, 0) + n
+        doc['contents'] = contents
+        docs["d%d" % i] = doc
+    return docs
+
+
+class ScoreDocsTopkTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        random.seed(42)
+        cls.docs = product_docs(2000)
+        cls.lucene = FakeLucene(cls.docs)
+        cls.index_dir = tempfile.mkdtemp()
+        open(cls.index_dir + "/segments_1", "w").close()
+        index_stats.save_index_stats(
+            cls.index_dir, index_stats.compute_index_stats(cls.lucene, cls.docs.keys(), FIELD_WEIGHTS.keys(), "contents"))
+        # queries are terms from the name, brand and category of a product
+        cls.queries = []
+        for doc_id in random.sample(sorted(cls.docs), 15):
+            doc = cls.docs[doc_id]
+            query_terms = random.sample(sorted(set(doc['product_name']) | set(doc['brand']) | set(doc['category'])),
+                                        random.randint(1, 3))
+            candidates = [d for d in sorted(cls.docs) if any(t in cls.docs[d]['contents'] for t in query_terms)]
+            random.shuffle(candidates)
+            cls.queries.append((query_terms, candidates[:1000] + ["missing"]))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.index_dir)
+
+    def run_queries(self, k, index_dir=None, **params):
+        """Checks that the top-k equals exhaustive ranking for all queries; returns field reads and exhaustive ones."""
+        field_reads, exhaustive_field_reads = 0, 0
+        for query_terms, candidates in self.queries:
+            scorer_params = {'field_weights': FIELD_WEIGHTS, 'method': 'method3', 'smoothing_param': 0.1,
+                             'index_dir': index_dir, 'query_terms': query_terms}
+            scorer_params.update(params)
+            scorer = TestScorer(self.lucene, " ".join(query_terms), scorer_params)
+            exhaustive = sorted([(doc_id, scorer.score_doc(doc_id)) for doc_id in candidates],
+                                key=lambda x: x[1], reverse=True)[:k]
+            self.assertEqual(scorer.score_docs_topk(candidates, k), exhaustive)
+            field_reads += scorer.topk_stats['field_reads']
+            exhaustive_field_reads += scorer.topk_stats['exhaustive_field_reads']
+        return field_reads, exhaustive_field_reads
+
+    def test_exhaustive_ranking(self):
+        for method in ["method1", "method2", "method3"]:
+            for k in [1, 10, 100]:
+                self.run_queries(k, self.index_dir, method=method)
+        # without index statistics
+        self.run_queries(10, None)
+
+    def test_exhaustive_ranking_without_smoothing(self):
+        for method in ["method1", "method3"]:
+            self.run_queries(10, self.index_dir, method=method, smoothing_param=0.0)
+
+    def test_field_reads(self):
+        field_reads, exhaustive_field_reads = self.run_queries(10, self.index_dir)
+        self.assertLess(4 * field_reads, exhaustive_field_reads)
+        field_reads, exhaustive_field_reads = self.run_queries(100, self.index_dir)
+        self.assertLess(1.5 * field_reads, exhaustive_field_reads)
+
+    def test_index_stats(self):
+        stats = index_stats.load_index_stats(self.index_dir)
+        self.assertEqual(stats['contained_fields'], sorted(f for f in FIELD_WEIGHTS if f != "contents"))
+        self.assertEqual(stats['term_field_max']['brand'][self.docs['d0']['brand'].keys()[0]], 1)
+        self.assertEqual(stats['doc_field_lengths']['d0']['contents'], sum(self.docs['d0']['contents'].values()))
+
+
+if __name__ == '__main__':
+    unittest.main()